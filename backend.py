@@ -1,57 +1,177 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response
 from flask_cors import CORS
 import requests
 
 from generate_input_file import *
+from upstream_scheduler import UpstreamScheduler, DeadlineExceeded, remaining_budget, PRIORITY_PAGE, PRIORITY_BACKGROUND
+import columnar
+from response_cache import ResponseCache
+from json_stream import iter_json_array
 import os
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 
 app = Flask(__name__)
 # Configure CORS to allow requests from your frontend origin
-CORS(app, resources={r"/*": {"origins": "http://localhost:5173"}})
+CORS(app, resources={r"/*": {"origins": "http://localhost:5173"}},
+     expose_headers=['X-Partial-Results', 'X-Missing-Sources'])
 
 # Constants
 ITEMS_PER_PAGE = 50
+CATALYSISHUB_URL = 'https://api.catalysis-hub.org/graphql'
+# Time budget for one /query request, sources that are not done by then are left out
+QUERY_DEADLINE = float(os.environ.get('QUERY_DEADLINE_SECONDS', 10)) # seconds
 
-def query_local_data(reactants, products, surfaces, facets):
-  data = []
-  filterCondition = {'reactants': reactants if reactants != "~" else "", 
-                     'facet': facets, 
-                     'surfaceComposition': surfaces if surfaces != "~" else "",
-                     'products': products if products != "~" else ""}
+# Threads used to fetch the data sources of a /query request concurrently
+source_executor = ThreadPoolExecutor(max_workers=16)
 
+# Throttling of CatalysisHub calls shared by all requests handled by this process
+catalysisHub_scheduler = UpstreamScheduler(
+  rate=float(os.environ.get('CATALYSISHUB_RATE', 5)), # requests per second
+  burst=int(os.environ.get('CATALYSISHUB_BURST', 10)),
+  max_concurrency=int(os.environ.get('CATALYSISHUB_MAX_CONCURRENCY', 8)),
+  latency_threshold=float(os.environ.get('CATALYSISHUB_LATENCY_THRESHOLD', 5.0)), # seconds
+  request_timeout=float(os.environ.get('CATALYSISHUB_TIMEOUT', 30.0)) # seconds
+)
+
+# Persistent cache of upstream responses, shared by all worker processes
+response_cache = ResponseCache(
+  os.environ.get('MKM_CACHE_PATH', './mkm_cache.sqlite3'),
+  ttl=float(os.environ.get('MKM_CACHE_TTL', 3600)) # seconds
+)
+# JSON file with a list of {"reactants", "products", "surfaces", "facets"} filters to preload at startup
+HOT_FILTERS_FILE = os.environ.get('MKM_HOT_FILTERS', './hot_filters.json')
+LOCAL_CACHE_CHUNK_SIZE = 500 # local reactions per cache entry
+CACHE_PURGE_INTERVAL = float(os.environ.get('MKM_CACHE_PURGE_INTERVAL', 600)) # seconds
+WARM_CACHE_LEASE = 600 # seconds, upper bound for one warm-up if its process dies
+
+def local_filter_condition(reactants, products, surfaces, facets):
+  return {'reactants': reactants if reactants != "~" else "", 
+          'facet': facets, 
+          'surfaceComposition': surfaces if surfaces != "~" else "",
+          'products': products if products != "~" else ""}
+
+
+def format_local_item(item):
+  #Add data source key value pair to each reaction data 
+  item['dataSource'] = 'AiScia'
+  try: 
+    item['activationEnergy'] = float(item['activationEnergy'])
+  except:
+    item['activationEnergy'] = None
+  try:
+    item['reactionEnergy'] = float(item['reactionEnergy'])
+  except: 
+    item['reactionEnergy'] = None
+  return item
+
+
+def iter_local_data(reactants, products, surfaces, facets, deadline=None):
+  """Stream reactions from the local data service. Raises on request failures and 
+  DeadlineExceeded when the deadline passes before the stream is read. 
+  stream_local_data() adds the error handling and caching used by the endpoints"""
+  filterCondition = local_filter_condition(reactants, products, surfaces, facets)
   print("filterCondition: ",filterCondition)
-  
+
   try:
-    response = requests.post('http://10.161.209.65:5000/get_data', json=filterCondition)
+    with requests.post('http://10.161.209.65:5000/get_data', json=filterCondition, stream=True,
+                       timeout=remaining_budget(deadline)) as response:
+      print("response:", response)
+      if response.status_code != 200:
+        print("Responce Error")
+        response.raise_for_status()
+        return
+      if response.encoding is None:
+        response.encoding = 'utf-8'
+      for item in iter_json_array(response.iter_content(chunk_size=64 * 1024, decode_unicode=True)):
+        remaining_budget(deadline)
+        yield format_local_item(item['node'])
+  except requests.RequestException as e:
+    if deadline is not None and time.monotonic() >= deadline:
+      raise DeadlineExceeded("Deadline exceeded waiting for the local data service") from e
+    raise
 
-    print("response:", response)
-    if response.status_code == 200:
-      data = [item['node'] for item in response.json()]
-      #Add data source key value pair to each reaction data 
-      for item in data: 
-        item['dataSource'] = 'AiScia'
-        try: 
-          item['activationEnergy'] = float(item['activationEnergy'])
-        except:
-          item['activationEnergy'] = None
-        try:
-          item['reactionEnergy'] = float(item['reactionEnergy'])
-        except: 
-          item['reactionEnergy'] = None
-      print("data:", data)
-      return data
+
+def stream_local_data(reactants, products, surfaces, facets, deadline=None):
+  """Generator over the local reactions with the error handling and caching used by 
+  the endpoints, callers can stop early or only count them. A failed request ends the 
+  stream early and is not cached, DeadlineExceeded is passed on to the caller. 
+  Rows are cached in chunks so neither a cache hit nor a miss holds the whole table"""
+  key = response_cache.make_key(reactants, products, surfaces, facets)
+  cached_rows = 0 # rows already yielded from the cache
+  chunk_count = response_cache.get('local_data', key)
+  if chunk_count is not None:
+    for index in range(chunk_count):
+      rows = response_cache.get('local_data_chunk', response_cache.make_key(reactants, products, surfaces, facets, index))
+      if rows is None:
+        # Fetch again and continue after the rows that were already yielded
+        print("Cached local data is incomplete, fetching it again.")
+        break
+      cached_rows += len(rows)
+      yield from rows
     else:
-      print("Responce Error")
-      return []
+      return
+
+  started = time.time()
+  chunk = []
+  chunk_count = 0
+  row_count = 0
+  cache_complete = True
+  try:
+    for item in iter_local_data(reactants, products, surfaces, facets, deadline):
+      chunk.append(item)
+      row_count += 1
+      if row_count > cached_rows:
+        yield item
+      if len(chunk) == LOCAL_CACHE_CHUNK_SIZE:
+        cache_complete &= response_cache.set('local_data_chunk', response_cache.make_key(reactants, products, surfaces, facets, chunk_count), chunk)
+        chunk_count += 1
+        chunk = []
   except requests.ConnectionError:
     print("Failed to connect to local data service.")
-    return []
+    return
   except requests.RequestException as e:
     print("Request failed:", e)
-    return []
+    return
+  except ValueError as e:
+    print("Invalid response from local data service:", e)
+    return
+
+  if chunk:
+    cache_complete &= response_cache.set('local_data_chunk', response_cache.make_key(reactants, products, surfaces, facets, chunk_count), chunk)
+    chunk_count += 1
+  if not cache_complete:
+    return
+  # Only complete responses whose chunks were all written are cached. The chunk list is 
+  # written last and expires no later than the first chunk, so a cache hit finds all of 
+  # its chunks unless they were removed from the file
+  ttl = response_cache.ttl - (time.time() - started)
+  response_cache.set('local_data', key, chunk_count, ttl=ttl)
+  response_cache.set('local_count', key, row_count, ttl=ttl)
+
+
+def query_local_data(reactants, products, surfaces, facets, deadline=None):
+  data = list(stream_local_data(reactants, products, surfaces, facets, deadline))
+  print("data:", len(data), "reactions")
+  return data
+
+
+def count_local_data(reactants, products, surfaces, facets):
+  count = response_cache.get('local_count', response_cache.make_key(reactants, products, surfaces, facets))
+  if count is not None:
+    return count
+  return sum(1 for _ in stream_local_data(reactants, products, surfaces, facets))
+
 
+def query_catalysisHub_data(reactants, products, surfaces, facets, after_cursor=None, priority=PRIORITY_PAGE, deadline=None):
+  key = response_cache.make_key(reactants, products, surfaces, facets, after_cursor)
+  cached = response_cache.get('catalysisHub_page', key)
+  if cached is not None:
+    formattedData, end_cursor, has_next_page = cached
+    return formattedData, end_cursor, has_next_page
 
-def query_catalysisHub_data(reactants, products, surfaces, facets, after_cursor=None):
   after_clause = f', after: "{after_cursor}"' if after_cursor else ''
   query = f'''
   query {{
@@ -90,7 +210,7 @@ def query_catalysisHub_data(reactants, products, surfaces, facets, after_cursor=
   '''
 
   try: 
-    response = requests.post('https://api.catalysis-hub.org/graphql', json={'query': query})
+    response = catalysisHub_scheduler.hedged_post(CATALYSISHUB_URL, priority=priority, deadline=deadline, json={'query': query})
     if response.status_code == 200:
       # Extract the dictionaries inside each "node" object
       data = response.json()['data']['reactions']
@@ -101,7 +221,9 @@ def query_catalysisHub_data(reactants, products, surfaces, facets, after_cursor=
         ## TO DO - what should the default values be 
         ## is there a way to calculate the nessary data???
         item['molecularData'] = '{"defualt": {"molecularWeight": 1,"symmetrySigma": 1, "rotationalConstant": 1}}'
-      return formattedData, data['pageInfo']['endCursor'], data['pageInfo']['hasNextPage']
+      end_cursor, has_next_page = data['pageInfo']['endCursor'], data['pageInfo']['hasNextPage']
+      response_cache.set('catalysisHub_page', key, [formattedData, end_cursor, has_next_page])
+      return formattedData, end_cursor, has_next_page
     else:
       return [], None, False
   except requests.ConnectionError:
@@ -112,7 +234,12 @@ def query_catalysisHub_data(reactants, products, surfaces, facets, after_cursor=
     return [], None, False
 
     
-def query_total_count(reactants, products, surfaces, facets):
+def query_total_count(reactants, products, surfaces, facets, priority=PRIORITY_BACKGROUND):
+  key = response_cache.make_key(reactants, products, surfaces, facets)
+  cached = response_cache.get('total_count', key)
+  if cached is not None:
+    return cached
+
   query = f'''
   query {{
     reactions(first: 1, surfaceComposition:"{surfaces}", facet:"~{facets}", reactants: "{reactants}", products: "{products}") {{
@@ -150,9 +277,11 @@ def query_total_count(reactants, products, surfaces, facets):
   '''
   
   try:
-    response = requests.post('https://api.catalysis-hub.org/graphql', json={'query': query})
+    response = catalysisHub_scheduler.post(CATALYSISHUB_URL, priority=priority, json={'query': query})
     if response.status_code == 200:
-      return response.json()['data']['reactions']['totalCount']
+      total_count = response.json()['data']['reactions']['totalCount']
+      response_cache.set('total_count', key, total_count)
+      return total_count
     else:
       return 0
   except requests.ConnectionError:
@@ -163,6 +292,55 @@ def query_total_count(reactants, products, surfaces, facets):
     return 0
 
 
+def catalysisHub_page_cursor(reactants, products, surfaces, facets, page, deadline=None):
+  """Return (after_cursor, has_page) for the given table page. The cursor chain is 
+  cached per page so later requests skip the page walk"""
+  if page == 1:
+    return None, True
+  key = response_cache.make_key(reactants, products, surfaces, facets, page)
+  cached = response_cache.get('cursor', key)
+  if cached is not None:
+    after_cursor, has_page = cached
+    return after_cursor, has_page
+
+  # Walk the pages, these come from the page cache when they were fetched before
+  after_cursor = None
+  for _ in range(page - 1):
+    _, after_cursor, has_next_page = query_catalysisHub_data(reactants, products, surfaces, facets, after_cursor,
+                                                             deadline=deadline)
+    if not has_next_page:
+      return None, False
+  response_cache.set('cursor', key, [after_cursor, True])
+  return after_cursor, True
+
+
+def fetch_catalysisHub_page(reactants, products, surfaces, facets, page, deadline=None):
+  after_cursor, has_page = catalysisHub_page_cursor(reactants, products, surfaces, facets, page, deadline)
+  if not has_page:
+    return []  # No more data
+  catalysisHubData, _, _ = query_catalysisHub_data(reactants, products, surfaces, facets, after_cursor,
+                                                   deadline=deadline)
+  return catalysisHubData
+
+
+def reactions_response(data, missing_sources=()):
+  """Send the reactions as JSON rows, or in the compact columnar format when the 
+  client asks for it with ?format=columnar or the Accept header. Sources that did 
+  not answer in time are listed in the X-Missing-Sources header"""
+  wants_columnar = (request.args.get('format') == 'columnar' or
+                    request.accept_mimetypes.best_match(['application/json', columnar.MIMETYPE]) == columnar.MIMETYPE)
+  if wants_columnar:
+    response = Response(columnar.encode_reactions(data), mimetype=columnar.MIMETYPE)
+  else:
+    response = jsonify(data)
+  # The format depends on the Accept header, shared caches must not mix them up
+  response.vary.add('Accept')
+  if missing_sources:
+    response.headers['X-Partial-Results'] = 'true'
+    response.headers['X-Missing-Sources'] = ','.join(missing_sources)
+  return response
+
+
 # API endpoint to query data from the database
 @app.route('/query', methods=['GET'])
 def query_data():
@@ -180,24 +358,32 @@ def query_data():
     section that into table pages, have this taken into consideration 
     when making requests from catalysisHub
     For exmple: if we have 5 local data then we need 45 cataylsisHub data for the first page"""
+    deadline = time.monotonic() + QUERY_DEADLINE
+    sources = {}
     if page == 1: 
-      localData = query_local_data(reactants, products, surfaces, facets)
-    else: 
-      localData = []
-
+      sources['AiScia'] = source_executor.submit(query_local_data, reactants, products, surfaces, facets, deadline)
 
     # Fetch data from Catalysis Hub API
-    after_cursor = None
-    if page > 1:
-      for _ in range(page - 1):
-        _, after_cursor, has_next_page = query_catalysisHub_data(reactants, products, surfaces, facets, after_cursor)
-        if not has_next_page:
-          return jsonify([])  # No more data
+    sources['CatalysisHub'] = source_executor.submit(fetch_catalysisHub_page, reactants, products, surfaces, facets,
+                                                     page, deadline)
 
-    catalysisHubData, _, _ = query_catalysisHub_data(reactants, products, surfaces, facets, after_cursor)
-
-    data = localData + catalysisHubData
-    return jsonify(data)
+    # Return whatever finished within the budget instead of waiting for the slowest source
+    wait(sources.values(), timeout=max(0, deadline - time.monotonic()))
+    data = []
+    missing_sources = []
+    for source, future in sources.items():
+      if not future.done():
+        # Do not start sources that are still queued after the response is sent
+        future.cancel()
+        missing_sources.append(source)
+        continue
+      try:
+        data += future.result()
+      except DeadlineExceeded:
+        missing_sources.append(source)
+    if missing_sources:
+      print("Deadline exceeded, missing sources:", missing_sources)
+    return reactions_response(data, missing_sources)
   except Exception as e:
     print("An error occurred:", e)
     return jsonify({"error": "An unexpected error occurred."}), 500
@@ -216,8 +402,7 @@ def get_total_count():
     catalysisHub_count = query_total_count(reactants, products, surfaces, facets)
 
     #Local data
-    localData = query_local_data(reactants, products, surfaces, facets)
-    local_data_count = len(localData)
+    local_data_count = count_local_data(reactants, products, surfaces, facets)
 
     total_count = catalysisHub_count + local_data_count
 
@@ -245,5 +430,63 @@ def generate_input_file_route():
     return jsonify({"error": "An unexpected error occurred."}), 500
 
 
+def load_hot_filters():
+  if not os.path.exists(HOT_FILTERS_FILE):
+    return []
+  try:
+    with open(HOT_FILTERS_FILE) as file:
+      return json.load(file)
+  except (OSError, ValueError) as e:
+    print("Failed to load hot filters:", e)
+    return []
+
+
+def warm_cache(filters):
+  """Preload the first page and the counts of popular filters into the persistent cache.
+  Filters whose entries are still fresh are served from the cache and not fetched again"""
+  for hot_filter in filters:
+    reactants = hot_filter.get('reactants') or "~"
+    products = hot_filter.get('products') or "~"
+    surfaces = hot_filter.get('surfaces') or "~"
+    facets = hot_filter.get('facets') or ""
+    try:
+      query_total_count(reactants, products, surfaces, facets, priority=PRIORITY_BACKGROUND)
+      query_catalysisHub_data(reactants, products, surfaces, facets, priority=PRIORITY_BACKGROUND)
+      query_local_data(reactants, products, surfaces, facets)
+    except Exception as e:
+      print("Failed to warm cache for", hot_filter, ":", e)
+
+
+def warm_cache_once(filters):
+  """Warm the cache unless another process is already warming the same filter list. 
+  The lease is only held while warming, it expires by itself if this process dies"""
+  lease = response_cache.make_key('warm_cache', filters)
+  if not response_cache.claim(lease, WARM_CACHE_LEASE):
+    return
+  try:
+    warm_cache(filters)
+  finally:
+    response_cache.release(lease)
+
+
+def purge_cache_periodically():
+  while True:
+    # One purge per interval across all workers
+    if response_cache.claim('purge_cache', CACHE_PURGE_INTERVAL):
+      response_cache.purge_expired()
+    time.sleep(CACHE_PURGE_INTERVAL)
+
+
+def start_cache_tasks():
+  """Call once per process at startup (from __main__, or e.g. a gunicorn post_fork hook). 
+  Starts the periodic purge of stale cache entries and preloads the hot filters, both in 
+  the background so startup is not delayed"""
+  threading.Thread(target=purge_cache_periodically, daemon=True).start()
+  filters = load_hot_filters()
+  if filters:
+    threading.Thread(target=warm_cache_once, args=(filters,), daemon=True).start()
+
+
 if __name__ == '__main__':
+  start_cache_tasks()
   app.run(debug=False)
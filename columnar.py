@@ -0,0 +1,113 @@
+"""Compact columnar encoding of the reaction rows returned by /query.
+Rows are stored column by column so keys are written once per column instead of once
+per reaction. Repetitive string columns are dictionary encoded and the energies are
+packed as little endian float64 arrays.
+
+Layout:
+  MAGIC | version (uint8) | header length (uint32) | header (utf-8 JSON) | packed blocks
+The header lists the column names in row order, the plain columns, the dictionaries, the
+rows where a key is absent and the rows where a float is None. The packed blocks follow:
+first one array of codes per dictionary column, then one float64 array per float column,
+each in header order."""
+
+import json
+import math
+import struct
+
+MIMETYPE = 'application/vnd.mkm.columnar'
+MAGIC = b'MKMC'
+VERSION = 2
+
+DICTIONARY_COLUMNS = ('surfaceComposition', 'facet', 'dataSource')
+FLOAT_COLUMNS = ('activationEnergy', 'reactionEnergy')
+
+_PREFIX = struct.Struct('<4sBI')
+
+
+def _code_format(dictionary_size):
+  # Smallest unsigned integer type that can index the dictionary
+  if dictionary_size <= 0xFF:
+    return 'B'
+  if dictionary_size <= 0xFFFF:
+    return 'H'
+  return 'I'
+
+
+def _is_float_column(values):
+  return all(value is None or (isinstance(value, (int, float)) and not isinstance(value, bool))
+             for value in values)
+
+
+def encode_reactions(rows):
+  """Encode a list of reaction dictionaries into the columnar byte format"""
+  count = len(rows)
+  names = list(dict.fromkeys(name for row in rows for name in row))
+
+  header = {'count': count, 'names': names, 'columns': {}, 'dictionaryColumns': [], 'floatColumns': [], 'absent': {},
+            'nulls': {}}
+  code_blocks = []
+  float_blocks = []
+
+  for name in names:
+    absent = [index for index, row in enumerate(rows) if name not in row]
+    absent_rows = set(absent)
+    if absent:
+      header['absent'][name] = absent
+    values = [row.get(name) for row in rows]
+
+    if name in FLOAT_COLUMNS and _is_float_column(values):
+      header['floatColumns'].append(name)
+      # None is listed separately so real NaN values survive the round trip
+      nulls = [index for index, value in enumerate(values) if value is None and index not in absent_rows]
+      if nulls:
+        header['nulls'][name] = nulls
+      packed = [math.nan if value is None else float(value) for value in values]
+      float_blocks.append(struct.pack(f'<{count}d', *packed))
+    elif name in DICTIONARY_COLUMNS and all(isinstance(value, str) or value is None for value in values):
+      dictionary = {}
+      codes = [dictionary.setdefault(value, len(dictionary)) for value in values]
+      code_format = _code_format(len(dictionary))
+      header['dictionaryColumns'].append({'name': name, 'values': list(dictionary), 'format': code_format})
+      code_blocks.append(struct.pack(f'<{count}{code_format}', *codes))
+    else:
+      header['columns'][name] = values
+
+  header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+  return _PREFIX.pack(MAGIC, VERSION, len(header_bytes)) + header_bytes + b''.join(code_blocks + float_blocks)
+
+
+def decode_reactions(payload):
+  """Decode bytes produced by encode_reactions() back into a list of reaction dictionaries"""
+  magic, version, header_length = _PREFIX.unpack_from(payload, 0)
+  if magic != MAGIC:
+    raise ValueError("Not a columnar reaction payload")
+  if version != VERSION:
+    raise ValueError(f"Unsupported columnar format version: {version}")
+
+  offset = _PREFIX.size
+  header = json.loads(payload[offset:offset + header_length].decode('utf-8'))
+  offset += header_length
+  count = header['count']
+
+  columns = dict(header['columns'])
+  for column in header['dictionaryColumns']:
+    code_format = f"<{count}{column['format']}"
+    codes = struct.unpack_from(code_format, payload, offset)
+    offset += struct.calcsize(code_format)
+    columns[column['name']] = [column['values'][code] for code in codes]
+  for name in header['floatColumns']:
+    float_format = f'<{count}d'
+    values = struct.unpack_from(float_format, payload, offset)
+    offset += struct.calcsize(float_format)
+    columns[name] = list(values)
+    for index in header['nulls'].get(name, ()):
+      columns[name][index] = None
+
+  rows = [{} for _ in range(count)]
+  for name in header['names']:
+    for row, value in zip(rows, columns[name]):
+      row[name] = value
+  for name, absent in header['absent'].items():
+    for index in absent:
+      del rows[index][name]
+  return rows
@@ -0,0 +1,64 @@
+"""Incremental parsing of a top level JSON array read from a stream of text chunks,
+so large response bodies never have to be held in memory at once."""
+import json
+
+# What the parser expects next
+_ARRAY_START = 0 # the opening '['
+_FIRST_ELEMENT = 1 # an element or ']' right after '['
+_ELEMENT = 2 # an element after ','
+_SEPARATOR = 3 # ',' or ']' after an element
+
+
+def iter_json_array(chunks):
+  """Yield the elements of a top level JSON array one at a time from an iterable
+  of text chunks. Raises ValueError for malformed or truncated arrays"""
+  decoder = json.JSONDecoder()
+  chunks = iter(chunks)
+  buffer = ''
+  position = 0
+  expected = _ARRAY_START
+
+  while True:
+    while position < len(buffer) and buffer[position].isspace():
+      position += 1
+
+    if position < len(buffer):
+      char = buffer[position]
+      if expected == _ARRAY_START:
+        if char != '[':
+          raise ValueError("Expected a JSON array")
+        expected = _FIRST_ELEMENT
+        position += 1
+        continue
+      if expected == _SEPARATOR:
+        if char == ']':
+          return
+        if char != ',':
+          raise ValueError(f"Expected ',' or ']' at position {position}")
+        expected = _ELEMENT
+        position += 1
+        continue
+      if char == ']' and expected == _FIRST_ELEMENT:
+        return
+      if char in ',]':
+        raise ValueError(f"Expected an array element at position {position}")
+      try:
+        element, end = decoder.raw_decode(buffer, position)
+      except json.JSONDecodeError:
+        pass # element is not complete yet, read more of the stream
+      else:
+        # A number may continue in the next chunk (e.g. 123 split as "12" + "3", or
+        # -3e-07 as "-3" + "e-07"), so only yield it once a delimiter follows it
+        is_number = char == '-' or char.isdigit()
+        if end < len(buffer) and (not is_number or buffer[end].isspace() or buffer[end] in ',]'):
+          position = end
+          expected = _SEPARATOR
+          yield element
+          continue
+
+    chunk = next(chunks, None)
+    if chunk is None:
+      raise ValueError("Unexpected end of JSON array")
+    # Drop the consumed part of the buffer
+    buffer = buffer[position:] + chunk
+    position = 0
@@ -0,0 +1,98 @@
+"""Persistent cache for upstream responses (CatalysisHub pages, counts, cursors and local data).
+Entries live in a SQLite file so they survive restarts and are shared by every worker
+process on the machine. The file is only opened on first use, not when the cache object
+is created. Each entry stores the cache version and an expiry time, entries written by
+another version or past their expiry are treated as missing."""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_VERSION = 1
+
+
+class ResponseCache:
+  def __init__(self, path, ttl, version=CACHE_VERSION):
+    self.path = path
+    self.ttl = ttl # seconds
+    self.version = version
+    self._local = threading.local()
+
+  def _connection(self):
+    # sqlite3 connections can not be shared between threads or carried across fork(), 
+    # keep one per thread and open a new one when the thread is in a forked worker
+    connection = getattr(self._local, 'connection', None)
+    if connection is None or self._local.pid != os.getpid():
+      connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+      # WAL lets readers in other processes continue while one process writes
+      connection.execute('PRAGMA journal_mode=WAL')
+      connection.execute('PRAGMA synchronous=NORMAL')
+      connection.execute('''CREATE TABLE IF NOT EXISTS cache (
+                              kind TEXT NOT NULL,
+                              key TEXT NOT NULL,
+                              version INTEGER NOT NULL,
+                              created_at REAL NOT NULL,
+                              expires_at REAL NOT NULL,
+                              value TEXT NOT NULL,
+                              PRIMARY KEY (kind, key))''')
+      self._local.connection = connection
+      self._local.pid = os.getpid()
+    return connection
+
+  def _execute(self, statement, parameters=()):
+    return self._connection().execute(statement, parameters)
+
+  @staticmethod
+  def make_key(*parts):
+    return json.dumps(parts, separators=(',', ':'))
+
+  def get(self, kind, key):
+    """Return the cached value or None when it is missing, stale or from another version"""
+    try:
+      row = self._execute('SELECT value FROM cache WHERE kind = ? AND key = ? AND version = ? AND expires_at > ?',
+                          (kind, key, self.version, time.time())).fetchone()
+    except sqlite3.Error as e:
+      print("Cache read failed:", e)
+      return None
+    return json.loads(row[0]) if row else None
+
+  def set(self, kind, key, value, ttl=None):
+    """Store a value, returns False when the write failed"""
+    now = time.time()
+    try:
+      self._execute('INSERT OR REPLACE INTO cache (kind, key, version, created_at, expires_at, value) VALUES (?, ?, ?, ?, ?, ?)',
+                    (kind, key, self.version, now, now + (self.ttl if ttl is None else ttl), json.dumps(value)))
+    except sqlite3.Error as e:
+      print("Cache write failed:", e)
+      return False
+    return True
+
+  def claim(self, name, ttl):
+    """Take a lease shared by all processes using the cache file. Returns True only for 
+    the process that got it, the lease expires after ttl seconds"""
+    now = time.time()
+    try:
+      self._execute("DELETE FROM cache WHERE kind = 'lease' AND key = ? AND (expires_at <= ? OR version != ?)",
+                    (name, now, self.version))
+      cursor = self._execute("INSERT OR IGNORE INTO cache (kind, key, version, created_at, expires_at, value) VALUES ('lease', ?, ?, ?, ?, ?)",
+                             (name, self.version, now, now + ttl, json.dumps(os.getpid())))
+    except sqlite3.Error as e:
+      print("Cache lease failed:", e)
+      return False
+    return cursor.rowcount == 1
+
+  def release(self, name):
+    """Give up a lease taken with claim()"""
+    try:
+      self._execute("DELETE FROM cache WHERE kind = 'lease' AND key = ?", (name,))
+    except sqlite3.Error as e:
+      print("Cache lease release failed:", e)
+
+  def purge_expired(self):
+    """Delete stale entries and entries written by other cache versions"""
+    try:
+      self._execute('DELETE FROM cache WHERE expires_at <= ? OR version != ?', (time.time(), self.version))
+    except sqlite3.Error as e:
+      print("Cache purge failed:", e)
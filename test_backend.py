@@ -0,0 +1,179 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip('flask')
+
+import backend
+from response_cache import ResponseCache
+
+
+class StreamedResponse:
+  def __init__(self, body, status_code=200):
+    self.body = body
+    self.status_code = status_code
+    self.encoding = 'utf-8'
+
+  def iter_content(self, chunk_size, decode_unicode):
+    for i in range(0, len(self.body), chunk_size):
+      yield self.body[i:i + chunk_size]
+
+  def raise_for_status(self):
+    raise backend.requests.HTTPError(f"{self.status_code} Error")
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    return False
+
+
+class FailingChunkCache(ResponseCache):
+  """Cache whose writes of one local data chunk fail"""
+  def __init__(self, path, ttl, failing_chunk):
+    super().__init__(path, ttl)
+    self.failing_chunk = failing_chunk
+
+  def set(self, kind, key, value, ttl=None):
+    if kind == 'local_data_chunk' and json.loads(key)[-1] == self.failing_chunk:
+      return False
+    return super().set(kind, key, value, ttl)
+
+
+@pytest.fixture
+def local_service(monkeypatch):
+  """Local data service returning `rows` reactions, counts the requests it gets"""
+  calls = []
+
+  def serve(rows):
+    body = json.dumps([{'node': {'id': i, 'activationEnergy': str(i), 'reactionEnergy': 'n/a'}} for i in range(rows)])
+
+    def post(url, **kwargs):
+      calls.append(url)
+      return StreamedResponse(body)
+    monkeypatch.setattr(backend.requests, 'post', post)
+    return calls
+  return serve
+
+
+def test_local_data_cached_in_chunks(tmp_path, monkeypatch, local_service):
+  monkeypatch.setattr(backend, 'response_cache', ResponseCache(str(tmp_path / 'cache.sqlite3'), ttl=60))
+  calls = local_service(1200)
+
+  data = backend.query_local_data('~', '~', '~', '')
+  assert [item['id'] for item in data] == list(range(1200))
+  assert data[3]['activationEnergy'] == 3.0 and data[3]['reactionEnergy'] is None
+
+  assert backend.query_local_data('~', '~', '~', '') == data
+  assert backend.count_local_data('~', '~', '~', '') == 1200
+  assert len(calls) == 1
+
+
+def test_failed_chunk_write_is_not_cached(tmp_path, monkeypatch, local_service):
+  monkeypatch.setattr(backend, 'response_cache', FailingChunkCache(str(tmp_path / 'cache.sqlite3'), ttl=60, failing_chunk=1))
+  calls = local_service(1200)
+
+  assert len(backend.query_local_data('~', '~', '~', '')) == 1200
+  key = backend.response_cache.make_key('~', '~', '~', '')
+  assert backend.response_cache.get('local_data', key) is None
+  assert backend.response_cache.get('local_count', key) is None
+  assert len(backend.query_local_data('~', '~', '~', '')) == 1200
+  assert len(calls) == 2
+
+
+def test_missing_chunk_falls_through_to_fetch(tmp_path, monkeypatch, local_service):
+  monkeypatch.setattr(backend, 'response_cache', ResponseCache(str(tmp_path / 'cache.sqlite3'), ttl=60))
+  calls = local_service(1200)
+  backend.query_local_data('~', '~', '~', '')
+  backend.response_cache._execute("DELETE FROM cache WHERE kind = 'local_data_chunk' AND key = ?",
+                                  (backend.response_cache.make_key('~', '~', '~', '', 1),))
+
+  data = backend.query_local_data('~', '~', '~', '')
+  assert [item['id'] for item in data] == list(range(1200))
+  assert len(calls) == 2
+
+
+def test_warm_cache_lease_is_per_filter_list_and_released(tmp_path, monkeypatch):
+  monkeypatch.setattr(backend, 'response_cache', ResponseCache(str(tmp_path / 'cache.sqlite3'), ttl=60))
+  warmed = []
+  monkeypatch.setattr(backend, 'warm_cache', warmed.append)
+  filters = [{'reactants': 'CO'}]
+
+  # Another process is warming this filter list
+  lease = backend.response_cache.make_key('warm_cache', filters)
+  assert backend.response_cache.claim(lease, 60)
+  backend.warm_cache_once(filters)
+  assert warmed == []
+
+  # An edited filter list is warmed right away
+  edited = filters + [{'products': 'CO2'}]
+  backend.warm_cache_once(edited)
+  assert warmed == [edited]
+
+  # The lease is only held while warming
+  backend.response_cache.release(lease)
+  backend.warm_cache_once(filters)
+  backend.warm_cache_once(filters)
+  assert warmed == [edited, filters, filters]
+
+
+@pytest.mark.parametrize('headers', [{}, {'Accept': 'application/vnd.mkm.columnar'}])
+def test_query_response_varies_on_accept(monkeypatch, headers):
+  monkeypatch.setattr(backend, 'query_local_data', lambda *args: [])
+  monkeypatch.setattr(backend, 'fetch_catalysisHub_page', lambda *args: [])
+  response = backend.app.test_client().get('/query', headers=headers)
+  assert response.status_code == 200
+  assert 'Accept' in response.headers['Vary']
+
+
+def test_slow_source_is_left_out_at_the_deadline(monkeypatch):
+  monkeypatch.setattr(backend, 'QUERY_DEADLINE', 0.2)
+  monkeypatch.setattr(backend, 'query_local_data', lambda *args: [{'id': 'local'}])
+
+  def slow_catalysisHub(*args):
+    time.sleep(1)
+    return [{'id': 'hub'}]
+  monkeypatch.setattr(backend, 'fetch_catalysisHub_page', slow_catalysisHub)
+
+  response = backend.app.test_client().get('/query')
+  assert response.get_json() == [{'id': 'local'}]
+  assert response.headers['X-Partial-Results'] == 'true'
+  assert response.headers['X-Missing-Sources'] == 'CatalysisHub'
+
+
+def test_deadline_exceeded_source_is_missing(monkeypatch):
+  monkeypatch.setattr(backend, 'query_local_data', lambda *args: [{'id': 'local'}])
+
+  def expired(*args):
+    raise backend.DeadlineExceeded("Deadline exceeded")
+  monkeypatch.setattr(backend, 'fetch_catalysisHub_page', expired)
+
+  response = backend.app.test_client().get('/query')
+  assert response.get_json() == [{'id': 'local'}]
+  assert response.headers['X-Missing-Sources'] == 'CatalysisHub'
+
+
+def test_complete_response_has_no_partial_marker(monkeypatch):
+  monkeypatch.setattr(backend, 'query_local_data', lambda *args: [{'id': 'local'}])
+  monkeypatch.setattr(backend, 'fetch_catalysisHub_page', lambda *args: [{'id': 'hub'}])
+
+  response = backend.app.test_client().get('/query')
+  assert response.get_json() == [{'id': 'local'}, {'id': 'hub'}]
+  assert 'X-Partial-Results' not in response.headers
+
+
+def test_queued_sources_are_cancelled_at_the_deadline(monkeypatch):
+  # One worker - the CatalysisHub fetch is still queued behind the slow local fetch
+  executor = ThreadPoolExecutor(max_workers=1)
+  monkeypatch.setattr(backend, 'source_executor', executor)
+  monkeypatch.setattr(backend, 'QUERY_DEADLINE', 0.1)
+  monkeypatch.setattr(backend, 'query_local_data', lambda *args: time.sleep(0.3) or [])
+  started = []
+  monkeypatch.setattr(backend, 'fetch_catalysisHub_page', lambda *args: started.append(args) or [])
+
+  response = backend.app.test_client().get('/query')
+  assert response.headers['X-Missing-Sources'] == 'AiScia,CatalysisHub'
+  executor.shutdown(wait=True)
+  assert started == []
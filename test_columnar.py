@@ -0,0 +1,58 @@
+import json
+import math
+import struct
+
+import pytest
+
+import columnar
+from columnar import encode_reactions, decode_reactions
+
+
+def reaction(index, **fields):
+  row = {'Equation': 'CO + * -> CO*', 'id': f'id{index}', 'facet': '111', 'surfaceComposition': 'Pt',
+         'dataSource': 'CatalysisHub', 'activationEnergy': 0.5 + index, 'reactionEnergy': -0.25 * index,
+         'reactionSystems': [{'name': 'CO*', 'energyCorrection': 0, 'aseId': 'x'}]}
+  row.update(fields)
+  return row
+
+
+def test_round_trip():
+  rows = [reaction(i, facet=['111', '100', '211'][i % 3]) for i in range(50)]
+  payload = encode_reactions(rows)
+  assert decode_reactions(payload) == rows
+  assert len(payload) < len(json.dumps(rows))
+
+
+def test_absent_keys_stay_absent():
+  rows = [reaction(0), {'facet': '100', 'molecularData': '{}'}, reaction(2)]
+  del rows[2]['activationEnergy']
+  decoded = decode_reactions(encode_reactions(rows))
+  assert decoded == rows
+  assert [list(row) for row in decoded] == [list(row) for row in rows]
+
+
+def test_none_and_nan_energies():
+  rows = [reaction(0, activationEnergy=None), reaction(1, activationEnergy=math.nan), reaction(2)]
+  decoded = decode_reactions(encode_reactions(rows))
+  assert decoded[0]['activationEnergy'] is None
+  assert math.isnan(decoded[1]['activationEnergy'])
+  assert decoded[2]['activationEnergy'] == 2.5
+
+
+def test_none_in_dictionary_columns():
+  rows = [reaction(0, surfaceComposition=None), reaction(1), reaction(2, facet=None)]
+  assert decode_reactions(encode_reactions(rows)) == rows
+
+
+def test_empty_rows():
+  assert decode_reactions(encode_reactions([])) == []
+
+
+def test_rejects_other_payloads():
+  payload = encode_reactions([reaction(0)])
+  with pytest.raises(ValueError):
+    decode_reactions(b'XXXX' + payload[4:])
+  version_offset = len(columnar.MAGIC)
+  other_version = payload[:version_offset] + struct.pack('<B', columnar.VERSION - 1) + payload[version_offset + 1:]
+  with pytest.raises(ValueError):
+    decode_reactions(other_version)
@@ -0,0 +1,28 @@
+import json
+
+import pytest
+
+from json_stream import iter_json_array
+
+
+def split(text, size):
+  return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 1000])
+def test_chunk_boundaries(size):
+  values = [123, 456, 1.5, 20, -3e-7, "a,]}\"b", None, True, [], {},
+            {'node': {'activationEnergy': '1.5', 'facet': '111'}}, [1, [2, 3]]]
+  text = json.dumps(values, indent=1)
+  assert list(iter_json_array(split(text, size))) == values
+
+
+@pytest.mark.parametrize('text', ['[]', ' [ ] ', '[\n]'])
+def test_empty_array(text):
+  assert list(iter_json_array(split(text, 1))) == []
+
+
+@pytest.mark.parametrize('text', ['[1,,2]', '[{"a":1} {"b":2}]', '[1,]', '[,1]', '[1 2]', '{"a": 1}', '[1, 2', ''])
+def test_malformed_arrays(text):
+  with pytest.raises(ValueError):
+    list(iter_json_array(split(text, 1)))
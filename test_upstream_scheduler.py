@@ -0,0 +1,165 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('requests')
+
+import upstream_scheduler
+from upstream_scheduler import UpstreamScheduler, PRIORITY_PAGE, PRIORITY_BACKGROUND
+
+
+class Response:
+  def __init__(self, status_code=200):
+    self.status_code = status_code
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+  """Stubbed requests.post, records the keyword arguments of every call"""
+  calls = []
+
+  def serve(status_code=200, delay=0.0, delays=()):
+    delays = list(delays)
+
+    def post(url, **kwargs):
+      calls.append(kwargs)
+      time.sleep(delays.pop(0) if delays else delay)
+      return Response(status_code)
+    monkeypatch.setattr(upstream_scheduler.requests, 'post', post)
+    return calls
+  return serve
+
+
+def wait_for_queue(scheduler, length):
+  for _ in range(200):
+    if len(scheduler._waiting) == length:
+      return
+    time.sleep(0.005)
+  raise AssertionError("requests did not queue")
+
+
+def test_token_bucket_spacing():
+  scheduler = UpstreamScheduler(rate=20, burst=1, max_concurrency=8)
+  start = time.monotonic()
+  for _ in range(4):
+    scheduler.acquire()
+    scheduler.release(0.0)
+  # The first token is in the bucket, the next three arrive 1/20 s apart
+  assert time.monotonic() - start >= 0.14
+
+
+def test_page_requests_go_before_background_work():
+  scheduler = UpstreamScheduler(rate=1000, burst=100, max_concurrency=1)
+  scheduler.acquire()
+  order = []
+
+  def request(name, priority):
+    scheduler.acquire(priority)
+    order.append(name)
+    scheduler.release(0.0)
+
+  threads = []
+  for name, priority in [('count', PRIORITY_BACKGROUND), ('bulk', PRIORITY_BACKGROUND), ('page', PRIORITY_PAGE)]:
+    threads.append(threading.Thread(target=request, args=(name, priority)))
+    threads[-1].start()
+    wait_for_queue(scheduler, len(threads))
+  scheduler.release(0.0)
+  for thread in threads:
+    thread.join()
+  assert order == ['page', 'count', 'bulk']
+
+
+def test_limit_is_halved_once_per_window():
+  scheduler = UpstreamScheduler(rate=1000, burst=100, max_concurrency=8)
+  # Three requests in flight together all come back slow
+  for _ in range(3):
+    scheduler.acquire()
+  for _ in range(3):
+    scheduler.release(1.0, congested=True)
+  assert scheduler.concurrency_limit == 4
+
+  # A request sent after the cut starts a new window
+  time.sleep(0.01)
+  scheduler.acquire()
+  scheduler.release(0.001, congested=True)
+  assert scheduler.concurrency_limit == 2
+
+
+def test_limit_is_clamped():
+  scheduler = UpstreamScheduler(rate=1000, burst=100, max_concurrency=4, min_concurrency=1)
+  for _ in range(5):
+    scheduler.acquire()
+    scheduler.release(0.0, congested=True)
+  assert scheduler.concurrency_limit == 1
+
+  for _ in range(100):
+    scheduler.acquire()
+    scheduler.release(0.0)
+  assert scheduler.concurrency_limit == 4
+
+
+def test_post_backs_off_on_429(upstream):
+  upstream(status_code=429)
+  scheduler = UpstreamScheduler(rate=1000, burst=100, max_concurrency=8)
+  assert scheduler.post('url').status_code == 429
+  assert scheduler.concurrency_limit == 4
+
+
+def test_post_timeout_is_always_bounded(upstream):
+  calls = upstream()
+  scheduler = UpstreamScheduler(rate=1000, burst=100, max_concurrency=8, request_timeout=30.0)
+  scheduler.post('url')
+  scheduler.post('url', deadline=time.monotonic() + 1.0)
+  assert calls[0]['timeout'] == 30.0
+  assert 0 < calls[1]['timeout'] <= 1.0
+
+
+def seed_latencies(scheduler, latency=0.01):
+  for _ in range(upstream_scheduler.MIN_HEDGE_SAMPLES):
+    scheduler._latencies.append(latency)
+
+
+def test_slow_request_is_hedged(upstream):
+  calls = upstream(delays=[0.5, 0.01])
+  scheduler = UpstreamScheduler(rate=1000, burst=100, max_concurrency=8)
+  seed_latencies(scheduler)
+  start = time.monotonic()
+  assert scheduler.hedged_post('url', deadline=time.monotonic() + 2).status_code == 200
+  assert time.monotonic() - start < 0.3
+  assert len(calls) == 2
+
+
+def test_no_hedge_while_requests_are_queued(upstream):
+  calls = upstream(delay=0.2)
+  scheduler = UpstreamScheduler(rate=0.1, burst=1, max_concurrency=8)
+  seed_latencies(scheduler)
+  with scheduler._cond:
+    scheduler._tokens = 0
+
+  # Background work waiting for a token the whole time the page request runs
+  timed_out = []
+
+  def background():
+    try:
+      scheduler.acquire(PRIORITY_BACKGROUND, deadline=time.monotonic() + 0.6)
+    except upstream_scheduler.DeadlineExceeded:
+      timed_out.append(True)
+  waiter = threading.Thread(target=background)
+  waiter.start()
+  wait_for_queue(scheduler, 1)
+  copies = []
+  submit = scheduler._hedge_executor.submit
+  scheduler._hedge_executor.submit = lambda *args: copies.append(args) or submit(*args)
+  page = threading.Thread(target=scheduler.hedged_post, args=('url',))
+  page.start()
+  wait_for_queue(scheduler, 2)
+  with scheduler._cond:
+    scheduler._tokens = 1
+    scheduler._cond.notify_all()
+
+  page.join()
+  waiter.join()
+  assert timed_out == [True]
+  assert len(copies) == 1
+  assert len(calls) == 1
@@ -0,0 +1,208 @@
+"""Scheduler for outgoing requests to a rate limited upstream API (CatalysisHub).
+Caps the number of requests in flight, spaces them out with a token bucket and
+adapts the concurrency limit with AIMD: the limit grows slowly while the upstream
+answers quickly and is halved on a 429/503 or a latency spike, at most once per
+window of requests that were in flight when it was last cut."""
+
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+
+# Priorities - lower values are served first
+PRIORITY_PAGE = 0 # user facing table page requests
+PRIORITY_BACKGROUND = 1 # counts, bulk and background work
+
+# Minimum number of latency samples before requests are hedged
+MIN_HEDGE_SAMPLES = 20
+
+
+class DeadlineExceeded(Exception):
+  """Raised when the time budget of a request runs out before the upstream answered"""
+
+
+class _Abandoned(Exception):
+  """Raised in a queued hedge copy that is no longer needed"""
+
+
+def remaining_budget(deadline):
+  """Seconds left until the deadline (a time.monotonic() value), None without a deadline"""
+  if deadline is None:
+    return None
+  remaining = deadline - time.monotonic()
+  if remaining <= 0:
+    raise DeadlineExceeded("Deadline exceeded")
+  return remaining
+
+
+class UpstreamScheduler:
+  def __init__(self, rate, burst, max_concurrency, min_concurrency=1, latency_threshold=5.0, request_timeout=30.0):
+    self.rate = float(rate) # tokens added per second
+    self.burst = float(burst) # maximum tokens stored in the bucket
+    self.max_concurrency = max_concurrency
+    self.min_concurrency = min_concurrency
+    self.latency_threshold = latency_threshold # seconds before a response counts as a spike
+    self.request_timeout = request_timeout # seconds, bounds how long a request holds its slot
+
+    self._cond = threading.Condition()
+    self._tokens = self.burst
+    self._last_refill = time.monotonic()
+    self._limit = float(max_concurrency)
+    self._last_decrease = float('-inf') # time.monotonic() of the last multiplicative decrease
+    self._in_flight = 0
+    self._waiting = [] # heap of (priority, sequence) tickets
+    self._sequence = itertools.count()
+    self._latencies = deque(maxlen=200) # recent response times in seconds
+    self._hedge_executor = ThreadPoolExecutor(max_workers=2 * max_concurrency)
+
+  @property
+  def concurrency_limit(self):
+    return int(self._limit)
+
+  def _refill(self):
+    now = time.monotonic()
+    self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+    self._last_refill = now
+
+  def p95(self):
+    """95th percentile of the recent response times, None until there are enough samples"""
+    with self._cond:
+      if len(self._latencies) < MIN_HEDGE_SAMPLES:
+        return None
+      latencies = sorted(self._latencies)
+    return latencies[int(0.95 * (len(latencies) - 1))]
+
+  def _is_queue_empty(self):
+    with self._cond:
+      return not self._waiting
+
+  def _leave_queue(self, ticket):
+    self._waiting.remove(ticket)
+    heapq.heapify(self._waiting)
+    self._cond.notify_all()
+
+  def acquire(self, priority=PRIORITY_PAGE, deadline=None, abandoned=None):
+    """Block until the caller may send a request. Waiting callers are served by
+    priority and then in arrival order. Raises DeadlineExceeded if the deadline 
+    passes while waiting."""
+    with self._cond:
+      ticket = (priority, next(self._sequence))
+      heapq.heappush(self._waiting, ticket)
+      while True:
+        if deadline is not None and time.monotonic() >= deadline:
+          self._leave_queue(ticket)
+          raise DeadlineExceeded("Deadline exceeded while waiting for a CatalysisHub slot")
+        if abandoned is not None and abandoned.is_set():
+          self._leave_queue(ticket)
+          raise _Abandoned()
+        self._refill()
+        is_next = self._waiting[0] == ticket
+        has_slot = self._in_flight < int(self._limit)
+        if is_next and has_slot and self._tokens >= 1:
+          heapq.heappop(self._waiting)
+          self._tokens -= 1
+          self._in_flight += 1
+          # Let the next ticket in line re-check the slots / tokens
+          self._cond.notify_all()
+          return
+        timeout = None
+        if is_next and has_slot:
+          # Only waiting on the bucket - sleep until the next token is due
+          timeout = (1 - self._tokens) / self.rate
+        if deadline is not None:
+          remaining = deadline - time.monotonic()
+          timeout = remaining if timeout is None else min(timeout, remaining)
+        self._cond.wait(timeout)
+
+  def release(self, latency, congested=False):
+    """Give back the slot taken by acquire() and adjust the concurrency limit."""
+    with self._cond:
+      self._in_flight -= 1
+      if not congested:
+        self._latencies.append(latency)
+      if congested or latency > self.latency_threshold:
+        # Multiplicative decrease, once per window - responses to requests that were 
+        # already in flight at the last cut belong to the window that was cut
+        now = time.monotonic()
+        if now - latency > self._last_decrease:
+          self._limit = max(float(self.min_concurrency), self._limit / 2)
+          self._last_decrease = now
+      else:
+        # Additive increase - roughly one extra slot per window of successful requests
+        self._limit = min(float(self.max_concurrency), self._limit + 1 / self._limit)
+      self._cond.notify_all()
+
+  def post(self, url, priority=PRIORITY_PAGE, deadline=None, **kwargs):
+    """requests.post() that goes through the scheduler. The request times out after 
+    request_timeout seconds, or earlier when the deadline leaves less budget."""
+    return self._post(url, priority, deadline, kwargs)
+
+  def _post(self, url, priority, deadline, kwargs, dispatched=None, abandoned=None):
+    # dispatched is set once the request leaves the queue (sent or failed),
+    # abandoned makes a request that is still queued give up
+    try:
+      self.acquire(priority, deadline, abandoned)
+    finally:
+      if dispatched is not None:
+        dispatched.set()
+    start = time.monotonic()
+    congested = True
+    try:
+      # Always bounded, a hung connection would otherwise keep its slot forever
+      timeout = self.request_timeout
+      if deadline is not None:
+        timeout = min(timeout, remaining_budget(deadline))
+      response = requests.post(url, **dict(kwargs, timeout=timeout))
+      congested = response.status_code in (429, 503)
+      return response
+    except requests.RequestException as e:
+      if deadline is not None and time.monotonic() >= deadline:
+        raise DeadlineExceeded("Deadline exceeded waiting for CatalysisHub") from e
+      raise
+    finally:
+      self.release(time.monotonic() - start, congested)
+
+  def hedged_post(self, url, priority=PRIORITY_PAGE, deadline=None, **kwargs):
+    """post() that sends a second copy of the request when the first one takes 
+    longer than the recent p95 latency after it was sent. Only use it for idempotent 
+    requests, the first successful response is returned."""
+    hedge_after = self.p95()
+    if hedge_after is None:
+      return self.post(url, priority, deadline, **kwargs)
+
+    dispatched = threading.Event()
+    first = self._hedge_executor.submit(self._post, url, priority, deadline, kwargs, dispatched)
+    # Time spent queued for a token or a slot is not upstream latency, so the hedge 
+    # timer only starts once the first copy is sent
+    dispatched.wait(None if deadline is None else max(0, deadline - time.monotonic()))
+    if deadline is None:
+      timeout = hedge_after
+    else:
+      timeout = min(hedge_after, max(0, deadline - time.monotonic()))
+    done, _ = wait([first], timeout=timeout)
+    # No hedge when out of time, or while other requests are queued - the bucket or 
+    # the concurrency limit is the bottleneck then, not the upstream
+    if done or (deadline is not None and time.monotonic() >= deadline) or not self._is_queue_empty():
+      return first.result()
+
+    abandoned = threading.Event()
+    second = self._hedge_executor.submit(self._post, url, priority, deadline, kwargs, None, abandoned)
+    try:
+      pending = {first, second}
+      while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+          if future.exception() is None:
+            return future.result()
+      # Both copies failed, report the error of the original request
+      return first.result()
+    finally:
+      # Do not let a copy that is still queued use up a token and a slot
+      second.cancel()
+      abandoned.set()
+      with self._cond:
+        self._cond.notify_all()